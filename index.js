@@ -1,60 +1,242 @@
 const path = require('path');
 const fs = require("fs");
+const crypto = require("crypto");
 
 require('dotenv').config()
 const { createClient } = require("@deepgram/sdk");
 
-const transcribeFile = async (fileName) => {
-  // STEP 1: Create a Deepgram client using the API key
-  
-  const deepgram = createClient(process.env.DEEPGRAM_API_KEY);
+// STEP 1: Create a single Deepgram client using the API key, shared by every
+// file instead of constructing a new client per transcription.
+const deepgram = createClient(process.env.DEEPGRAM_API_KEY);
 
-  // STEP 2: Call the transcribeFile method with the audio payload and options
+// Deepgram options for audio analysis. Part of the cache key, so changing
+// them invalidates previously cached transcripts.
+const transcribeOptions = {
+  model: "nova-2",
+  smart_format: true,
+};
+
+// Transcripts are cached on disk, keyed by a hash of the options and the audio
+// contents, so re-running over the same recordings skips the Deepgram call.
+const outDir = "out";
+const cacheDir = path.join(outDir, ".transcript_cache");
+const cacheKey = (fileName) =>
+  new Promise((resolve, reject) => {
+    const hash = crypto
+      .createHash("sha256")
+      .update(JSON.stringify(transcribeOptions))
+      .update("\0");
+    fs.createReadStream(fileName)
+      .on("error", reject)
+      .on("data", (chunk) => hash.update(chunk))
+      .on("end", () => resolve(hash.digest("hex")));
+  });
+
+const readCache = async (key) => {
+  try {
+    return await fs.promises.readFile(path.join(cacheDir, `${key}.txt`), "utf8");
+  } catch (err) {
+    if (err.code === "ENOENT") return undefined;
+    throw err;
+  }
+};
+
+const writeCache = async (key, transcript) => {
+  await fs.promises.mkdir(cacheDir, { recursive: true });
+  const cachePath = path.join(cacheDir, `${key}.txt`);
+  // Write to a temp file and rename, so an interrupted run never leaves a
+  // truncated entry behind.
+  const tmpPath = `${cachePath}.${process.pid}.tmp`;
+  try {
+    await fs.promises.writeFile(tmpPath, transcript);
+    await fs.promises.rename(tmpPath, cachePath);
+  } catch (err) {
+    await fs.promises.rm(tmpPath, { force: true }).catch(() => {});
+    throw err;
+  }
+};
+
+// Transcriptions in flight, by cache key. Recordings with identical contents
+// share one Deepgram call instead of each paying for their own.
+const inflight = new Map();
+
+// `force` skips the cache lookup and always asks Deepgram, though the fresh
+// result is still cached.
+const transcribeFile = async (fileName, { force = false } = {}) => {
+  const key = await cacheKey(fileName);
+  if (!inflight.has(key)) {
+    const pending = transcribeUncached(fileName, key, { force });
+    inflight.set(key, pending);
+    pending.then(
+      () => inflight.delete(key),
+      () => inflight.delete(key)
+    );
+  }
+  return inflight.get(key);
+};
+
+const transcribeUncached = async (fileName, key, { force = false } = {}) => {
+  if (!force) {
+    const cached = await readCache(key);
+    if (cached !== undefined) return cached;
+  }
+
+  // STEP 2: Call the transcribeFile method with the audio payload and options.
+  // The audio is read only on a cache miss; it is sent as a Buffer because
+  // stream bodies were not verified against the SDK's fetch-based client.
   const { result, error } = await deepgram.listen.prerecorded.transcribeFile(
-    // path to the audio file
-    fs.readFileSync(fileName),
+    await fs.promises.readFile(fileName),
     // STEP 3: Configure Deepgram options for audio analysis
-    {
-      model: "nova-2",
-      smart_format: true,
-    }
+    transcribeOptions
   );
 
   if (error) throw error;
-  // STEP 4: Print the results
-  if (!error) {
-    return result.results.channels[0].alternatives[0].transcript;
+  // STEP 4: Return the results
+  const transcript = result.results.channels[0].alternatives[0].transcript;
+  // Empty transcripts are not cached, so the next run asks Deepgram again.
+  // The cache is only an optimization: failing to write it should not lose a
+  // transcript we already paid for.
+  if (transcript) {
+    await writeCache(key, transcript).catch((err) =>
+      console.warn(`Could not cache transcript for ${fileName}:`, err.message)
+    );
   }
+  return transcript;
 };
 
 
-const outDir = "out";
-const saveToDisk = async (input) => {
-    console.log(input)
-    const {name,transcript} = input;
+const outPathFor = (name) => {
     const justName = path.parse(name).name;
     const outName = `${justName}.md`;
-    const outPath = path.join(outDir,outName);
-    const contents = await transcript;
-    console.log(`Writing contents to: ${outPath}`)
-    await fs.writeFileSync(outPath,contents);
+    return path.join(outDir,outName);
 }
 
+const exists = async (filePath) => {
+    try {
+      await fs.promises.access(filePath);
+      return true;
+    } catch {
+      return false;
+    }
+}
+
+const saveToDisk = async (outPath, transcript) => {
+    await fs.promises.writeFile(outPath,transcript);
+}
+
+// Transcribe one file and save it as soon as its transcript is ready, rather
+// than waiting on the rest of the folder. Empty recordings are always skipped.
+// Unless `force`, files that already have a transcript are skipped and cached
+// transcripts are reused, so re-running over a folder only pays for what is
+// new. Returns a short status for the progress log.
+const processFile = async (name, { force = false } = {}) => {
+    const outPath = outPathFor(name);
+    if (!force && await exists(outPath)) return "skipped, output exists";
+    const { size } = await fs.promises.stat(name);
+    if (size === 0) return "skipped, empty file";
+    const transcript = await transcribeFile(name, { force });
+    // Like the cache, no output is written for an empty transcript, so the
+    // next run asks Deepgram again instead of skipping an empty file.
+    if (!transcript) return "skipped, empty transcript";
+    await saveToDisk(outPath, transcript);
+    return `written to ${outPath}`;
+}
 
-const inDir = "./in/"
-const files = fs.readdirSync(inDir); // read fileNames in input folder.
 
+const inDir = "./in/"
 const limiter = "202402"; // My Recorder names files by date of recording, starting with YYYYMM
-const filteredFiles = files
-  .filter(x=> x.startsWith(limiter)) // Limit Selections
-  .map(x=>`${inDir}${x}`); // Properly provide Path
 
-// console.log(filteredFiles);
-const transcripts = filteredFiles.map(transcribeFile);
-Promise.all(transcripts);
+// How many files are transcribed at once. Set with `--num-parallel N`,
+// `--num-parallel=N`, or the NUM_PARALLEL environment variable.
+const parseNumParallel = (argv) => {
+  const invalid = (raw) =>
+    new Error(`--num-parallel must be a positive integer, got: ${raw}`);
+  const i = argv.indexOf("--num-parallel");
+  let raw;
+  if (i >= 0) {
+    raw = argv[i + 1];
+    if (raw === undefined || raw.startsWith("--")) throw invalid(raw);
+  } else {
+    const inline = argv.find((x) => x.startsWith("--num-parallel="));
+    raw = inline ? inline.slice("--num-parallel=".length) : process.env.NUM_PARALLEL;
+    // An empty NUM_PARALLEL counts as unset.
+    if (!inline && raw === "") raw = undefined;
+  }
+  if (raw === undefined) return 4;
+  const n = Number(raw);
+  if (!Number.isInteger(n) || n < 1) throw invalid(raw);
+  return n;
+}
 
-const namesAndTranscripts = filteredFiles.map(function(name, i) {
-    return {name, transcript:transcripts[i]};
+// Run `worker` over `items` with at most `limit` in flight. Each worker pulls
+// the next item as soon as it finishes, so one slow file never holds up the
+// rest of the queue.
+const runPool = async (items, limit, worker) => {
+  const results = new Array(items.length);
+  let next = 0;
+  const consume = async () => {
+    while (next < items.length) {
+      const i = next++;
+      try {
+        results[i] = { status: "fulfilled", value: await worker(items[i]) };
+      } catch (reason) {
+        results[i] = { status: "rejected", reason };
+      }
+    }
+  };
+  await Promise.all(Array.from({ length: limit }, consume));
+  return results;
+}
+
+const main = async () => {
+  const args = process.argv.slice(2);
+  const numParallel = parseNumParallel(args);
+  const force = args.includes("--force"); // re-transcribe even if output or cache exists
+  await fs.promises.mkdir(outDir, { recursive: true });
+  // read entries in input folder; file types come from the directory listing
+  // itself, so only symlinks need a stat to see what they point at.
+  const isFileEntry = async (x) => {
+    if (x.isFile()) return true;
+    if (!x.isSymbolicLink()) return false;
+    // A broken link is kept so it shows up as a failure rather than vanishing.
+    return fs.promises.stat(`${inDir}${x.name}`).then((st) => st.isFile(), () => true);
+  };
+  const entries = fs.readdirSync(inDir, { withFileTypes: true })
+    .filter(x=> x.name.startsWith(limiter)); // Limit Selections
+  const keep = await Promise.all(entries.map(isFileEntry));
+  const filteredFiles = entries
+    .filter((x, i) => keep[i])
+    .map(x=>`${inDir}${x.name}`); // Properly provide Path
+
+  // No point starting more workers than there are files to hand them.
+  const workers = Math.min(numParallel, filteredFiles.length);
+  console.log(`Transcribing ${filteredFiles.length} file(s), ${workers} at a time`);
+
+  // One progress line per finished file; failures are collected and reported
+  // together at the end.
+  let done = 0;
+  const progress = (name, status) =>
+    console.log(`[${++done}/${filteredFiles.length}] ${name}: ${status}`);
+  const results = await runPool(filteredFiles, workers, async (name) => {
+    try {
+      progress(name, await processFile(name, { force }));
+    } catch (err) {
+      progress(name, "failed");
+      throw err;
+    }
   });
 
-namesAndTranscripts.map(saveToDisk);
+  const failures = results
+    .map((x, i) => ({ ...x, name: filteredFiles[i] }))
+    .filter(x => x.status === "rejected");
+  if (failures.length) {
+    console.error(`${failures.length} of ${filteredFiles.length} file(s) failed:`);
+    failures.forEach((x) => console.error(`  ${x.name}:`, x.reason));
+    process.exitCode = 1;
+  }
+}
+
+main().catch((err) => {
+  console.error(err);
+  process.exitCode = 1;
+});